@@ -1,20 +1,38 @@
 import os
 import re
 import base64
+import hashlib
 import sys
 import json
+import mimetypes
+import queue
+import threading
+import time
+import uuid
 import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory, flash, session, abort
+from functools import lru_cache
+from urllib.parse import quote
+from flask import Flask, render_template, request, redirect, url_for, send_from_directory, flash, session, abort, Response
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, inspect, literal_column, select, table, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, load_only, selectinload
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from werkzeug.utils import secure_filename
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from werkzeug.middleware.proxy_fix import ProxyFix
 from authlib.integrations.flask_client import OAuth
 from apscheduler.schedulers.background import BackgroundScheduler
 from imap_tools import MailBox, A
 import apprise
+import imagehash
+from pdf2image import convert_from_bytes
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 
 # Warnung von Google unterdrücken, damit die Logs lesbar bleiben
 warnings.filterwarnings("ignore", category=FutureWarning, module="google.generativeai")
@@ -25,6 +43,8 @@ DATA_DIR = os.path.join(BASE_DIR, 'data')
 UPLOAD_FOLDER = os.path.join(DATA_DIR, 'uploads')
 DB_PATH = os.path.join(DATA_DIR, 'bills.db')
 ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg'}
+PHASH_MAX_DISTANCE = 6  # Max. abweichende Bits, ab der eine PDF als "gleiche Rechnung" gilt
+PHASH_MAX_SIZE_DIFF = 0.01  # Max. relative Abweichung der Dateigrösse (1%)
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
@@ -35,9 +55,27 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-key-fallback')
 app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DB_PATH}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'query_cache_size': 1200,  # Cache für kompilierte Statements
+    'pool_pre_ping': True
+}
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB Limit
 
 db = SQLAlchemy(app)
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL erlaubt parallele Lesezugriffe während der Scheduler schreibt"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=134217728")  # 128MB
+    cursor.execute("PRAGMA cache_size=-20000")  # ~20MB
+    cursor.close()
+
+with app.app_context():
+    event.listen(db.engine, 'connect', _set_sqlite_pragmas)
+
 apobj = apprise.Apprise()
 
 # --- Auth Setup ---
@@ -61,17 +99,26 @@ IMAP_PASSWORD = os.environ.get('IMAP_PW')
 IMAP_OWNER_EMAIL = os.environ.get('IMAP_OWNER_EMAIL')
 NOTIFY_URL = os.environ.get('NOTIFY_URL')
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
+AI_DEBUG = os.environ.get('AI_DEBUG', '').lower() in ('1', 'true', 'yes')
+# Dateiauslieferung an den Webserver delegieren (Apache: X-Sendfile, Nginx: X-Accel-Redirect)
+USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
+X_ACCEL_REDIRECT_PREFIX = os.environ.get('X_ACCEL_REDIRECT_PREFIX')
+
+app.config['USE_X_SENDFILE'] = USE_X_SENDFILE
 
 if NOTIFY_URL:
     apobj.add(NOTIFY_URL)
 
+if GEMINI_API_KEY:
+    genai.configure(api_key=GEMINI_API_KEY)
+
 # --- DB Models ---
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(150), unique=True, nullable=False)
     password_hash = db.Column(db.String(200), nullable=True)
     name = db.Column(db.String(100))
-    bills = db.relationship('Bill', backref='owner', lazy=True, cascade="all, delete-orphan")
+    bills = db.relationship('Bill', back_populates='owner', lazy='select', cascade="all, delete-orphan")
     notify_url = db.Column(db.String(255), nullable=True)
     imap_server = db.Column(db.String(150), nullable=True)
     imap_user = db.Column(db.String(150), nullable=True)
@@ -81,44 +128,143 @@ class Bill(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(150), nullable=False)
     filename = db.Column(db.String(150), nullable=False, unique=True)
+    file_type = db.Column(db.String(8), default='pdf')  # 'pdf' oder 'image', beim Speichern gesetzt
     amount = db.Column(db.Float, nullable=True)
     status = db.Column(db.String(20), default='offen') 
     due_date = db.Column(db.Date, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.now)
     paid_at = db.Column(db.DateTime, nullable=True)
+    sha256 = db.Column(db.String(64), nullable=True)
+    phash = db.Column(db.String(16), nullable=True)  # Perceptual Hash der ersten PDF-Seite
+    sender = db.Column(db.String(150), nullable=True)  # Absender beim Mail-Import
+    file_size = db.Column(db.Integer, nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    files = db.relationship('BillFile', backref='bill', lazy=True, cascade="all, delete-orphan")
+    owner = db.relationship('User', back_populates='bills')
+    files = db.relationship('BillFile', back_populates='bill', lazy='select', cascade="all, delete-orphan")
+
+    # Indizes für die häufigsten Filter (Liste, Statistik, Reminder)
+    __table_args__ = (
+        db.Index('ix_bill_user_status_due', 'user_id', 'status', 'due_date'),
+        db.Index('ix_bill_user_status_paid', 'user_id', 'status', 'paid_at'),
+        db.Index('ix_bill_status_due', 'status', 'due_date'),
+        db.Index('ix_bill_user_sha256', 'user_id', 'sha256', unique=True),
+    )
 
     @property
     def days_left(self):
         if not self.due_date: return None
         return (self.due_date - datetime.now().date()).days
-    
-    @property
-    def file_type(self):
-        if '.' not in self.filename: return 'pdf'
-        ext = self.filename.rsplit('.', 1)[1].lower()
-        return 'image' if ext in ['jpg', 'jpeg', 'png'] else 'pdf'
 
 class BillFile(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     bill_id = db.Column(db.Integer, db.ForeignKey('bill.id'), nullable=False)
     filename = db.Column(db.String(150), nullable=False)
+    file_type = db.Column(db.String(8), default='pdf')
+    bill = db.relationship('Bill', back_populates='files')
 
-    @property
-    def file_type(self):
-        if '.' not in self.filename: return 'pdf'
-        ext = self.filename.rsplit('.', 1)[1].lower()
-        return 'image' if ext in ['jpg', 'jpeg', 'png'] else 'pdf'
+    __table_args__ = (
+        db.Index('ix_billfile_bill', 'bill_id'),
+    )
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
 
 # --- Helper ---
+def get_bill_or_404(id, *options):
+    """Rechnung per Primärschlüssel laden (Identity Map); fremde Rechnungen -> 404"""
+    bill = db.session.get(Bill, id, options=options)
+    if not bill or bill.user_id != current_user.id:
+        abort(404)
+    return bill
+
+password_hasher = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=1)
+
+def hash_password(password):
+    return password_hasher.hash(password)
+
+def verify_password(user, password):
+    """Prüft das Passwort; alte pbkdf2-Hashes werden beim Login auf Argon2 umgestellt"""
+    if not user.password_hash or not password:
+        return False
+
+    if user.password_hash.startswith('$argon2'):
+        try:
+            password_hasher.verify(user.password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        if password_hasher.check_needs_rehash(user.password_hash):
+            user.password_hash = hash_password(password)
+            db.session.commit()
+        return True
+
+    # Legacy: Werkzeug pbkdf2
+    if check_password_hash(user.password_hash, password):
+        user.password_hash = hash_password(password)
+        db.session.commit()
+        return True
+    return False
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+_notify_queue = queue.Queue(maxsize=1000)
+
+@lru_cache(maxsize=64)
+def _apprise_for(url):
+    """Eine Apprise-Instanz pro URL wiederverwenden statt bei jedem Aufruf neu aufzubauen"""
+    ap_inst = apprise.Apprise()
+    ap_inst.add(url)
+    return ap_inst
+
+def file_type_for(filename):
+    if '.' not in filename: return 'pdf'
+    ext = filename.rsplit('.', 1)[1].lower()
+    return 'image' if ext in ['jpg', 'jpeg', 'png'] else 'pdf'
+
+def pdf_phash(data):
+    """Perceptual Hash der ersten PDF-Seite (72 dpi) als Hex-String, None falls nicht möglich"""
+    try:
+        pages = convert_from_bytes(data, dpi=72, first_page=1, last_page=1)
+        return str(imagehash.phash(pages[0])) if pages else None
+    except Exception as e:
+        print(f"pHash Error: {e}", flush=True)
+        return None
+
+def find_similar_bill(phash, sender, size, known_phashes):
+    """Sucht eine erneut zugestellte Rechnung: gleicher Absender, fast gleiche Grösse und erste Seite
+
+    known_phashes: {Absender: [{'phash', 'size', 'title', 'amount'}, ...]}, neueste zuerst.
+    """
+    if not sender:
+        return None
+    current = imagehash.hex_to_hash(phash)
+    for known in known_phashes.get(sender, []):
+        if not known['size'] or abs(size - known['size']) > known['size'] * PHASH_MAX_SIZE_DIFF:
+            continue
+        if current - imagehash.hex_to_hash(known['phash']) <= PHASH_MAX_DISTANCE:
+            return known
+    return None
+
+def fts_query(q):
+    """Baut aus der Sucheingabe eine sichere FTS5-Abfrage (Teilstring-Suche pro Wort).
+
+    Gibt None zurück, wenn ein Wort kürzer als 3 Zeichen ist (Trigram-Index findet das nicht).
+    """
+    terms = q.split()
+    if not terms or any(len(t) < 3 for t in terms):
+        return None
+    return ' '.join('"' + t.replace('"', '""') + '"' for t in terms)
+
+def save_upload(file, path):
+    """Speichert einen Upload in 64 KiB Blöcken und gibt den SHA-256 Hash zurück"""
+    sha = hashlib.sha256()
+    with open(path, 'wb') as out:
+        for chunk in iter(lambda: file.stream.read(65536), b''):
+            sha.update(chunk)
+            out.write(chunk)
+    return sha.hexdigest()
+
 def send_notification(title, body, user=None):
     urls = []
     # 1. User Config
@@ -132,13 +278,82 @@ def send_notification(title, body, user=None):
     if not urls:
         return
 
-    for url in urls:
-        try:
-            ap_inst = apprise.Apprise()
-            ap_inst.add(url)
-            ap_inst.notify(body=body, title=title)
-        except Exception as e:
-            print(f"Notification Error ({url}): {e}")
+    # Nicht blockierend: der Versand läuft im Hintergrund-Thread
+    try:
+        _notify_queue.put_nowait((title, body, urls))
+    except queue.Full:
+        print(f"Notification Error: Queue voll, verworfen: {title}")
+
+def _notification_worker():
+    """Arbeitet die Benachrichtigungs-Queue ab, damit langsame Webhooks niemanden blockieren"""
+    while True:
+        title, body, urls = _notify_queue.get()
+        for url in urls:
+            try:
+                _apprise_for(url).notify(body=body, title=title)
+            except Exception as e:
+                print(f"Notification Error ({url}): {e}")
+        _notify_queue.task_done()
+
+AI_MODEL = 'models/gemini-2.0-flash'
+AI_CACHE_TTL = timedelta(hours=1)
+AI_CACHE_REFRESH = timedelta(minutes=5)  # Cache so lange vor Ablauf neu anlegen
+AI_PROMPT = """Analysiere diese Rechnung und extrahiere folgende Daten:
+1. Titel (Name des Unternehmens/Rechnungsstellers)
+2. Fälligkeitsdatum (Format YYYY-MM-DD). WICHTIG: Unterscheide strikt zwischen Rechnungsdatum (Invoice Date) und Fälligkeitsdatum (Due Date). Suche nach "Zahlbar bis", "Fällig am", "Due date". Nimm NICHT das Rechnungsdatum, es sei denn, es ist identisch mit dem Fälligkeitsdatum.
+3. Rechnungsbetrag (als Fliesskommazahl, z.B. 120.50)
+
+Antworte ausschliesslich mit einem validen JSON-Objekt in diesem Format:
+{"title": "string oder null", "date": "YYYY-MM-DD oder null", "amount": 0.00 oder null}"""
+
+_JSON_RE = re.compile(r'\{.*\}', re.DOTALL)
+
+_ai_model = None
+_ai_model_cached = False  # True, wenn _ai_model auf einem Context-Cache basiert
+_ai_model_refresh_at = 0.0  # time.monotonic(), ab dem der Cache erneuert wird
+_ai_model_lock = threading.Lock()
+
+def _get_ai_model():
+    """Liefert das (wiederverwendete) Modell mit serverseitig gecachtem Prompt (Context Caching).
+
+    Ist Caching nicht verfügbar (z.B. Prompt unter der Mindestgrösse), wird der
+    Prompt als System-Instruction mitgeschickt.
+    """
+    global _ai_model, _ai_model_cached, _ai_model_refresh_at
+    with _ai_model_lock:
+        if _ai_model_cached and time.monotonic() >= _ai_model_refresh_at:
+            # Cache läuft bald ab (TTL) -> rechtzeitig neu anlegen
+            _ai_model = None
+            _ai_model_cached = False
+        if _ai_model is None:
+            try:
+                cache = genai.caching.CachedContent.create(
+                    model=AI_MODEL,
+                    system_instruction=AI_PROMPT,
+                    ttl=AI_CACHE_TTL
+                )
+                _ai_model = genai.GenerativeModel.from_cached_content(cached_content=cache)
+                _ai_model_cached = True
+                _ai_model_refresh_at = time.monotonic() + (AI_CACHE_TTL - AI_CACHE_REFRESH).total_seconds()
+            except Exception as e:
+                print(f"AI Info: Context caching not available ({e}), sending prompt inline.", flush=True)
+                _ai_model = genai.GenerativeModel(AI_MODEL, system_instruction=AI_PROMPT)
+        return _ai_model
+
+def _reset_ai_model():
+    """Verwirft ein Cache-basiertes Modell (TTL abgelaufen). Gibt False zurück, wenn kein Cache im Spiel war"""
+    global _ai_model, _ai_model_cached
+    with _ai_model_lock:
+        if not _ai_model_cached:
+            return False
+        _ai_model = None
+        _ai_model_cached = False
+        return True
+
+@lru_cache(maxsize=1)
+def _list_models():
+    """Verfügbare Modelle nur einmal abfragen (langsamer API-Call)"""
+    return [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
 
 def analyze_bill_ai(filepath):
     """Versucht mittels AI Titel, Datum und Betrag aus der Datei zu lesen."""
@@ -149,17 +364,7 @@ def analyze_bill_ai(filepath):
     print(f"AI Info: Starting analysis for {os.path.basename(filepath)}", flush=True)
     
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel('models/gemini-2.0-flash')
-        
         ext = filepath.rsplit('.', 1)[1].lower()
-        prompt_text = """Analysiere diese Rechnung und extrahiere folgende Daten:
-1. Titel (Name des Unternehmens/Rechnungsstellers)
-2. Fälligkeitsdatum (Format YYYY-MM-DD). WICHTIG: Unterscheide strikt zwischen Rechnungsdatum (Invoice Date) und Fälligkeitsdatum (Due Date). Suche nach "Zahlbar bis", "Fällig am", "Due date". Nimm NICHT das Rechnungsdatum, es sei denn, es ist identisch mit dem Fälligkeitsdatum.
-3. Rechnungsbetrag (als Fliesskommazahl, z.B. 120.50)
-
-Antworte ausschliesslich mit einem validen JSON-Objekt in diesem Format:
-{"title": "string oder null", "date": "YYYY-MM-DD oder null", "amount": 0.00 oder null}"""
         content = []
         
         # MIME-Type bestimmen
@@ -176,7 +381,6 @@ Antworte ausschliesslich mit einem validen JSON-Objekt in diesem Format:
             with open(filepath, "rb") as f:
                 file_data = f.read()
             content = [
-                prompt_text,
                 {"mime_type": mime_type, "data": file_data}
             ]
         else:
@@ -184,17 +388,27 @@ Antworte ausschliesslich mit einem validen JSON-Objekt in diesem Format:
             return None
 
         print("AI Info: Sending request to Gemini...", flush=True)
-        response = model.generate_content(content)
-        ans = response.text.strip()
-        
-        # Markdown Code-Blöcke entfernen falls vorhanden
-        if ans.startswith('```json'):
-            ans = ans[7:]
-        if ans.endswith('```'):
-            ans = ans[:-3]
-            
         try:
-            data = json.loads(ans.strip())
+            response = _get_ai_model().generate_content(content)
+        except (google_exceptions.NotFound, google_exceptions.PermissionDenied):
+            # Cache abgelaufen/gelöscht (meldet die API als 404 oder 403) -> neu anlegen und nochmal versuchen.
+            # Ohne Cache (z.B. falscher Modellname) bringt ein Retry nichts.
+            if not _reset_ai_model():
+                raise
+            response = _get_ai_model().generate_content(content)
+        ans = response.text or ''
+        if not ans.strip():
+            print("AI Info: Empty response.", flush=True)
+            return None
+
+        # Erstes JSON-Objekt extrahieren (ignoriert Markdown Code-Blöcke & Text drumherum)
+        match = _JSON_RE.search(ans)
+        if not match:
+            print(f"AI Info: No JSON in response: {ans}", flush=True)
+            return None
+
+        try:
+            data = json.loads(match.group(0))
             result = {}
             
             if data.get('date'):
@@ -212,95 +426,181 @@ Antworte ausschliesslich mit einem validen JSON-Objekt in diesem Format:
             
     except Exception as e:
         print(f"AI Analysis Error: {e}", flush=True)
-        try:
-            print("--- DEBUG: Verfügbare Modelle für diesen Key ---", flush=True)
-            for m in genai.list_models():
-                if 'generateContent' in m.supported_generation_methods:
-                    print(f" - {m.name}", flush=True)
-        except Exception as e2:
-            print(f"Debug Error: {e2}", flush=True)
+        if AI_DEBUG:
+            try:
+                print("--- DEBUG: Verfügbare Modelle für diesen Key ---", flush=True)
+                for name in _list_models():
+                    print(f" - {name}", flush=True)
+            except Exception as e2:
+                print(f"Debug Error: {e2}", flush=True)
     return None
 
 # --- Background Logic ---
-def process_mailbox(server, user, password, owner):
-    """Hilfsfunktion zum Abrufen eines Postfachs"""
+# Netzwerk-Arbeit (IMAP Login/Download, Gemini) läuft in eigenen Pools,
+# damit der Scheduler-Thread nicht blockiert. Die DB bleibt im Scheduler-Thread.
+MAX_IMAP_WORKERS = 8
+_known_hashes_lock = threading.Lock()
+_AI_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix='ai')
+
+def process_mailbox(server, user, password, known_hashes, known_phashes):
+    """Hilfsfunktion zum Abrufen eines Postfachs (ohne DB-Zugriff, läuft im Thread-Pool)
+
+    Anhänge, deren SHA-256 in known_hashes steht, werden übersprungen.
+    Ist ein Anhang eine erneut zugestellte, bekannte Rechnung (gleicher Absender,
+    Grösse und erste Seite, siehe known_phashes), werden Titel und Betrag
+    übernommen statt die AI zu fragen. Die Fälligkeit wird nicht kopiert, da
+    Folgerechnungen oft gleich aussehen (Standard: +30 Tage).
+    Gibt eine Liste von (Betreff, [Rechnungsdaten]) pro Mail zurück.
+    """
+    messages = []
     try:
         with MailBox(server).login(user, password, initial_folder='INBOX') as mailbox:
             for msg in mailbox.fetch(A(seen=False)):
                 if msg.attachments:
-                    found_file = False
+                    sender = (msg.from_ or '').lower()[:150]
+                    pending = []
                     for att in msg.attachments:
                         if att.filename and att.filename.lower().endswith('.pdf'):
-                            secure_name = f"{int(datetime.now().timestamp())}_{att.filename}"
+                            sha256 = hashlib.sha256(att.payload).hexdigest()
+                            # known_hashes wird zwischen den Postfächern desselben Users geteilt
+                            with _known_hashes_lock:
+                                duplicate = sha256 in known_hashes
+                                known_hashes.add(sha256)
+                            if duplicate:
+                                print(f"IMAP Info: Skipping duplicate attachment {att.filename}", flush=True)
+                                continue
+
+                            # Eindeutiger Name: Postfächer laufen parallel, gleiche Anhangnamen dürfen sich nicht überschreiben
+                            secure_name = f"{uuid.uuid4().hex}_{secure_filename(att.filename) or 'rechnung.pdf'}"
                             save_path = os.path.join(UPLOAD_FOLDER, secure_name)
                             with open(save_path, 'wb') as f:
                                 f.write(att.payload)
                             
-                            default_due = datetime.now().date() + timedelta(days=30)
-                            
-                            # AI Analyse versuchen
-                            ai_data = analyze_bill_ai(save_path)
-                            
-                            due_date = default_due
-                            title = msg.subject[:100]
-                            amount = None
-
-                            if ai_data:
-                                if ai_data.get('date'): due_date = ai_data['date']
-                                if ai_data.get('title'): title = ai_data['title']
-                                if ai_data.get('amount'): amount = ai_data['amount']
-                            
-                            new_bill = Bill(
-                                title=title,
-                                filename=secure_name,
-                                due_date=due_date,
-                                amount=amount,
-                                user_id=owner.id
-                            )
-                            db.session.add(new_bill)
-                            try:
-                                db.session.commit()
-                                found_file = True
-                            except Exception:
-                                db.session.rollback()
-                    
-                    if found_file:
-                        send_notification("Neue Rechnung", f"Importiert: {msg.subject}", user=owner)
+                            phash = pdf_phash(att.payload)
+                            size = len(att.payload)
+                            similar = find_similar_bill(phash, sender, size, known_phashes) if phash else None
+                            if similar:
+                                print(f"AI Info: {att.filename} matches a known bill, skipping analysis.", flush=True)
+                                future = None
+                            else:
+                                # AI Analyse parallel starten
+                                future = _AI_POOL.submit(analyze_bill_ai, save_path)
+                            pending.append((secure_name, sha256, phash, size, similar, future))
+
+                    bills = []
+                    for secure_name, sha256, phash, size, similar, future in pending:
+                        ai_data = future.result() if future else similar
+
+                        due_date = datetime.now().date() + timedelta(days=30)
+                        title = msg.subject[:100]
+                        amount = None
+
+                        if ai_data:
+                            if ai_data.get('date'): due_date = ai_data['date']
+                            if ai_data.get('title'): title = ai_data['title']
+                            if ai_data.get('amount'): amount = ai_data['amount']
+
+                        bills.append({
+                            'title': title,
+                            'filename': secure_name,
+                            'file_type': file_type_for(secure_name),
+                            'due_date': due_date,
+                            'amount': amount,
+                            'sha256': sha256,
+                            'phash': phash,
+                            'sender': sender or None,
+                            'file_size': size
+                        })
+
+                    if bills:
+                        messages.append((msg.subject, bills))
     except Exception as e:
         print(f"IMAP Error for {user}: {e}")
+    return messages
 
 def fetch_emails():
     """Holt Mails für alle konfigurierten User + Global"""
     with app.app_context():
+        jobs = []
         # 1. Globale Konfiguration (Legacy / Docker Env)
         if all([IMAP_SERVER, IMAP_PASSWORD, IMAP_USER, IMAP_OWNER_EMAIL]):
             owner = User.query.filter_by(email=IMAP_OWNER_EMAIL).first()
             if owner:
-                process_mailbox(IMAP_SERVER, IMAP_USER, IMAP_PASSWORD, owner)
+                jobs.append((IMAP_SERVER, IMAP_USER, IMAP_PASSWORD, owner))
         
         # 2. Benutzer-spezifische Konfiguration
         users = User.query.filter(User.imap_server != None).all()
         for u in users:
             if u.imap_server and u.imap_user and u.imap_password:
-                process_mailbox(u.imap_server, u.imap_user, u.imap_password, u)
+                jobs.append((u.imap_server, u.imap_user, u.imap_password, u))
+
+        if not jobs:
+            return
+
+        # Pool nach Anzahl Postfächer dimensionieren: ein langsamer Server blockiert die anderen nicht
+        with ThreadPoolExecutor(max_workers=min(MAX_IMAP_WORKERS, len(jobs)), thread_name_prefix='imap') as pool:
+            futures = {}
+            known_hashes_by_owner = {}
+            for server, user, password, owner in jobs:
+                # Bekannte Hashes vorab laden, damit Duplikate weder gespeichert noch analysiert werden.
+                # Ein Set pro User, damit globales und eigenes Postfach dieselbe Mail nicht doppelt importieren.
+                if owner.id not in known_hashes_by_owner:
+                    known_hashes_by_owner[owner.id] = {h for (h,) in db.session.query(Bill.sha256).filter(Bill.user_id == owner.id, Bill.sha256 != None)}
+                known_hashes = known_hashes_by_owner[owner.id]
+                # Neueste Rechnung zuerst, damit bei ähnlichen PDFs die aktuellsten Daten übernommen werden
+                known_phashes = {}
+                rows = db.session.query(Bill.sender, Bill.phash, Bill.file_size, Bill.title, Bill.amount).filter(
+                    Bill.user_id == owner.id, Bill.phash != None, Bill.sender != None).order_by(Bill.created_at.desc())
+                for sender, phash, size, title, amount in rows:
+                    known_phashes.setdefault(sender, []).append(
+                        {'phash': phash, 'size': size, 'title': title, 'amount': amount})
+                futures[pool.submit(process_mailbox, server, user, password, known_hashes, known_phashes)] = owner
+
+            # Ergebnisse im Scheduler-Thread speichern (eine Session, ein Thread)
+            for future in as_completed(futures):
+                owner = futures[future]
+                for subject, bills in future.result():
+                    # Alle Anhänge einer Mail in einer Transaktion speichern
+                    for data in bills:
+                        db.session.add(Bill(user_id=owner.id, **data))
+                    try:
+                        db.session.commit()
+                    except Exception as e:
+                        db.session.rollback()
+                        print(f"Import Error ({subject}): {e}")
+                        continue
+
+                    send_notification("Neue Rechnung", f"Importiert: {subject}", user=owner)
 
 def check_due_dates():
     """Täglicher Reminder"""
     with app.app_context():
-        bills = Bill.query.filter_by(status='offen').all()
+        # Owner direkt mitladen, sonst ein SELECT pro Rechnung (N+1)
+        bills = Bill.query.options(joinedload(Bill.owner)).filter_by(status='offen').all()
         today = datetime.now().date()
+
+        # Pro User sammeln und eine einzige Nachricht schicken statt einer pro Rechnung
+        reminders = {}
         for bill in bills:
             if not bill.due_date: continue
             days = (bill.due_date - today).days
             
             if days <= 0:
-                send_notification("⚠️ ÜBERFÄLLIG", f"{bill.title} war fällig am {bill.due_date}!", user=bill.owner)
+                entry = reminders.setdefault(bill.user_id, {'owner': bill.owner, 'overdue': [], 'due3': []})
+                entry['overdue'].append(f"{bill.title} war fällig am {bill.due_date}!")
             elif days == 3:
-                send_notification("Erinnerung", f"{bill.title} ist in 3 Tagen fällig.", user=bill.owner)
+                entry = reminders.setdefault(bill.user_id, {'owner': bill.owner, 'overdue': [], 'due3': []})
+                entry['due3'].append(f"{bill.title} ist in 3 Tagen fällig.")
+
+        for entry in reminders.values():
+            title = "⚠️ ÜBERFÄLLIG" if entry['overdue'] else "Erinnerung"
+            send_notification(title, "\n".join(entry['overdue'] + entry['due3']), user=entry['owner'])
+
+threading.Thread(target=_notification_worker, name='notify', daemon=True).start()
 
 # Scheduler setup
 scheduler = BackgroundScheduler(daemon=True)
-scheduler.add_job(fetch_emails, 'interval', minutes=2)
+scheduler.add_job(fetch_emails, 'interval', minutes=2, max_instances=1, coalesce=True, misfire_grace_time=60)
 scheduler.add_job(check_due_dates, 'cron', hour=8, minute=0)
 scheduler.start()
 
@@ -316,7 +616,7 @@ def login():
         password = request.form.get('password')
         user = User.query.filter_by(email=email).first()
         
-        if user and user.password_hash and check_password_hash(user.password_hash, password):
+        if user and verify_password(user, password):
             login_user(user, remember=True)
             return redirect(url_for('index'))
         else:
@@ -336,7 +636,7 @@ def register():
         if User.query.filter_by(email=email).first():
             flash('Email existiert bereits.', 'error')
         else:
-            new_user = User(email=email, password_hash=generate_password_hash(password, method='pbkdf2:sha256'))
+            new_user = User(email=email, password_hash=hash_password(password))
             db.session.add(new_user)
             db.session.commit()
             login_user(new_user)
@@ -385,15 +685,23 @@ def logout():
 @app.route('/')
 @login_required
 def index():
-    q = request.args.get('q')
+    q = (request.args.get('q') or '').strip()
     
     query_open = Bill.query.filter_by(status='offen', user_id=current_user.id)
     query_paid = Bill.query.filter_by(status='bezahlt', user_id=current_user.id)
     
     if q:
-        # Einfache Suche im Titel
-        query_open = query_open.filter(Bill.title.contains(q))
-        query_paid = query_paid.filter(Bill.title.contains(q))
+        match = fts_query(q)
+        if match:
+            # Suche im Titel über den FTS5-Trigram-Index (als Subquery, bleibt in SQLite)
+            fts_ids = select(literal_column('rowid')).select_from(table('bill_fts')).where(
+                text('bill_fts MATCH :q').bindparams(q=match))
+            condition = Bill.id.in_(fts_ids)
+        else:
+            # Kurze Suchbegriffe (< 3 Zeichen) kann der Trigram-Index nicht finden
+            condition = Bill.title.contains(q)
+        query_open = query_open.filter(condition)
+        query_paid = query_paid.filter(condition)
         
     bills_open = query_open.order_by(Bill.due_date.asc().nulls_last()).all()
     
@@ -403,24 +711,24 @@ def index():
     else:
         bills_paid = query_paid.order_by(Bill.paid_at.desc()).limit(20).all()
         
-    total_open = sum(b.amount for b in bills_open if b.amount)
+    # Summe direkt in SQL berechnen (inkl. Suchfilter)
+    total_open = query_open.with_entities(func.coalesce(func.sum(Bill.amount), 0.0)).scalar()
     return render_template('index.html', bills_open=bills_open, bills_paid=bills_paid, user=current_user, total_open=total_open, search_query=q)
 
 @app.route('/stats')
 @login_required
 def stats():
-    # Nur bezahlte Rechnungen mit Betrag holen
-    bills = Bill.query.filter(Bill.status == 'bezahlt', Bill.user_id == current_user.id, Bill.amount != None).order_by(Bill.paid_at.asc()).all()
-    
-    data_map = {}
-    for b in bills:
-        if b.paid_at:
-            month = b.paid_at.strftime('%Y-%m')
-            data_map[month] = data_map.get(month, 0) + b.amount
-            
-    sorted_keys = sorted(data_map.keys())
-    labels = sorted_keys
-    values = [data_map[k] for k in sorted_keys]
+    # Nur bezahlte Rechnungen mit Betrag, direkt in SQL pro Monat summiert
+    month = func.strftime('%Y-%m', Bill.paid_at).label('month')
+    rows = db.session.query(month, func.sum(Bill.amount)).filter(
+        Bill.status == 'bezahlt',
+        Bill.user_id == current_user.id,
+        Bill.amount != None,
+        Bill.paid_at != None
+    ).group_by(month).order_by(month).all()
+
+    labels = [r[0] for r in rows]
+    values = [r[1] for r in rows]
     
     return render_template('stats.html', labels=labels, values=values)
 
@@ -492,24 +800,31 @@ def upload():
         # Haupt-Dateiname für die Bill-Tabelle (Legacy-Support & Thumbnail)
         first_file = valid_files[0]
         ext = first_file.filename.rsplit('.', 1)[1].lower()
-        ts = int(datetime.now().timestamp())
-        main_filename = f"manual_{ts}_0.{ext}"
-
-        new_bill = Bill(title=title, filename=main_filename, due_date=due_date, user_id=current_user.id)
-        db.session.add(new_bill)
-        db.session.flush() # ID generieren
+        # Eindeutiger Präfix statt Zeitstempel: parallele Uploads dürfen sich nicht überschreiben
+        token = uuid.uuid4().hex
+        main_filename = f"manual_{token}_0.{ext}"
 
         # Zuerst speichern, damit die Datei für die AI-Analyse existiert
-        for i, file in enumerate(valid_files):
-            # Dateiname generieren (der erste bekommt den main_filename)
-            if i == 0: 
-                save_name = main_filename
-            else: 
-                f_ext = file.filename.rsplit('.', 1)[1].lower()
-                save_name = f"manual_{ts}_{i}.{f_ext}"
-            
-            file.save(os.path.join(UPLOAD_FOLDER, save_name))
-            db.session.add(BillFile(bill_id=new_bill.id, filename=save_name))
+        main_path = os.path.join(UPLOAD_FOLDER, main_filename)
+        main_sha256 = save_upload(first_file, main_path)
+
+        # Identische Datei schon vorhanden -> kein Duplikat und kein erneuter AI-Aufruf
+        if Bill.query.filter_by(user_id=current_user.id, sha256=main_sha256).first():
+            os.remove(main_path)
+            flash('Diese Rechnung wurde bereits hochgeladen.', 'error')
+            return redirect(url_for('index'))
+
+        new_bill = Bill(title=title, filename=main_filename, file_type=file_type_for(main_filename), due_date=due_date, sha256=main_sha256, user_id=current_user.id)
+        new_bill.files.append(BillFile(filename=main_filename, file_type=file_type_for(main_filename)))
+        saved_paths = [main_path]
+
+        for i, file in enumerate(valid_files[1:], start=1):
+            f_ext = file.filename.rsplit('.', 1)[1].lower()
+            save_name = f"manual_{token}_{i}.{f_ext}"
+            save_path = os.path.join(UPLOAD_FOLDER, save_name)
+            save_upload(file, save_path)
+            saved_paths.append(save_path)
+            new_bill.files.append(BillFile(filename=save_name, file_type=file_type_for(save_name)))
 
         # AI Analyse starten
         ai_data = analyze_bill_ai(os.path.join(UPLOAD_FOLDER, main_filename))
@@ -522,13 +837,28 @@ def upload():
             if ai_data.get('amount'):
                 new_bill.amount = ai_data['amount']
 
-        db.session.commit()
+        # Erst nach der AI-Analyse schreiben, damit die Transaktion kurz bleibt
+        db.session.add(new_bill)
+        try:
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            # Nur die Dateien dieser Anfrage entfernen (Namen sind eindeutig)
+            for path in saved_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            if 'bill.sha256' in str(e.orig):
+                # Doppelt abgeschicktes Formular: die andere Anfrage war schneller (ix_bill_user_sha256)
+                flash('Diese Rechnung wurde bereits hochgeladen.', 'error')
+            else:
+                print(f"Upload Error: {e}")
+                flash('Rechnung konnte nicht gespeichert werden.', 'error')
     return redirect(url_for('index'))
 
 @app.route('/update_date/<int:id>', methods=['POST'])
 @login_required
 def update_date(id):
-    bill = Bill.query.filter_by(id=id, user_id=current_user.id).first_or_404()
+    bill = get_bill_or_404(id, load_only(Bill.id, Bill.due_date, Bill.user_id))
     date_str = request.form.get('due_date')
     if date_str:
         bill.due_date = datetime.strptime(date_str, '%Y-%m-%d').date()
@@ -538,7 +868,7 @@ def update_date(id):
 @app.route('/pay/<int:id>')
 @login_required
 def pay(id):
-    bill = Bill.query.filter_by(id=id, user_id=current_user.id).first_or_404()
+    bill = get_bill_or_404(id, load_only(Bill.id, Bill.status, Bill.paid_at, Bill.user_id))
     bill.status = 'bezahlt'
     bill.paid_at = datetime.now()
     db.session.commit()
@@ -550,13 +880,13 @@ def pay(id):
 @app.route('/bill/<int:id>')
 @login_required
 def bill_details(id):
-    bill = Bill.query.filter_by(id=id, user_id=current_user.id).first_or_404()
+    bill = get_bill_or_404(id, selectinload(Bill.files))
     return render_template('bill_details.html', bill=bill)
 
 @app.route('/edit/<int:id>', methods=['POST'])
 @login_required
 def edit_bill(id):
-    bill = Bill.query.filter_by(id=id, user_id=current_user.id).first_or_404()
+    bill = get_bill_or_404(id, load_only(Bill.id, Bill.title, Bill.due_date, Bill.amount, Bill.user_id))
     title = request.form.get('title')
     date_str = request.form.get('due_date')
     amount_str = request.form.get('amount')
@@ -581,7 +911,7 @@ def edit_bill(id):
 @app.route('/delete/<int:id>')
 @login_required
 def delete_bill(id):
-    bill = Bill.query.filter_by(id=id, user_id=current_user.id).first_or_404()
+    bill = get_bill_or_404(id, load_only(Bill.id, Bill.filename, Bill.user_id), selectinload(Bill.files))
     
     # Datei vom Dateisystem löschen
     files_to_delete = set()
@@ -615,9 +945,62 @@ def serve_file(filename):
         abort(404)
     if bill.user_id != current_user.id:
         abort(403)
+    if X_ACCEL_REDIRECT_PREFIX:
+        # Nginx liefert die Datei aus einer internal-Location, der Worker bleibt frei
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        return Response(mimetype=mimetype, headers={'X-Accel-Redirect': f"{X_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{quote(filename)}"})
     return send_from_directory(UPLOAD_FOLDER, filename)
 
+def init_db():
+    """Legt Tabellen an und bringt bestehende DBs auf den aktuellen Stand"""
+    db.create_all()
+
+    # Neue Spalten in bestehenden DBs nachziehen (kein Migrations-Tool im Einsatz)
+    new_columns = [
+        ('bill', 'sha256', 'VARCHAR(64)'),
+        ('bill', 'phash', 'VARCHAR(16)'),
+        ('bill', 'sender', 'VARCHAR(150)'),
+        ('bill', 'file_size', 'INTEGER'),
+        ('bill', 'file_type', "VARCHAR(8) DEFAULT 'pdf'"),
+        ('bill_file', 'file_type', "VARCHAR(8) DEFAULT 'pdf'"),
+    ]
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table_name, column, ddl in new_columns:
+            if column not in {c['name'] for c in inspector.get_columns(table_name)}:
+                conn.execute(text(f'ALTER TABLE {table_name} ADD COLUMN {column} {ddl}'))
+                if column == 'file_type':
+                    # Typ bestehender Dateien einmalig aus der Endung ableiten
+                    conn.execute(text(f"UPDATE {table_name} SET file_type = 'image' WHERE lower(filename) LIKE '%.jpg' OR lower(filename) LIKE '%.jpeg' OR lower(filename) LIKE '%.png'"))
+
+    # create_all legt Indizes nur für neue Tabellen an -> bestehende DBs nachziehen
+    for tbl in (Bill.__table__, BillFile.__table__):
+        for index in tbl.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+
+    # FTS5-Suchindex für Titel (Trigram = Teilstring-Suche), per Trigger synchron zur bill-Tabelle
+    with db.engine.begin() as conn:
+        fts_sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE type='table' AND name='bill_fts'")).scalar()
+        if fts_sql and 'trigram' not in fts_sql:
+            # Alter Index ohne Trigram-Tokenizer -> neu aufbauen
+            conn.execute(text("DROP TABLE bill_fts"))
+            fts_sql = None
+        conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS bill_fts USING fts5(title, content='bill', content_rowid='id', tokenize='trigram')"))
+        conn.execute(text("""CREATE TRIGGER IF NOT EXISTS bill_fts_ai AFTER INSERT ON bill BEGIN
+            INSERT INTO bill_fts(rowid, title) VALUES (new.id, new.title);
+        END"""))
+        conn.execute(text("""CREATE TRIGGER IF NOT EXISTS bill_fts_ad AFTER DELETE ON bill BEGIN
+            INSERT INTO bill_fts(bill_fts, rowid, title) VALUES ('delete', old.id, old.title);
+        END"""))
+        conn.execute(text("""CREATE TRIGGER IF NOT EXISTS bill_fts_au AFTER UPDATE OF title ON bill BEGIN
+            INSERT INTO bill_fts(bill_fts, rowid, title) VALUES ('delete', old.id, old.title);
+            INSERT INTO bill_fts(rowid, title) VALUES (new.id, new.title);
+        END"""))
+        if not fts_sql:
+            # Bestehende Rechnungen einmalig indexieren
+            conn.execute(text("INSERT INTO bill_fts(bill_fts) VALUES ('rebuild')"))
+
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        init_db()
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file